@@ -7,17 +7,30 @@
 # Date created : 12/03/2022
 #
 
+from __future__ import annotations
+
 import argparse
-import copy
+import codecs
 import csv
+import functools
+import gzip
+import http.client
 from html.parser import HTMLParser
-from sys import exit
+import io
+import operator
+import re
+from sys import exit, stdout
+from typing import Iterator
 import urllib.parse
 import urllib.request
 
 API_URL = 'https://bookfinder.com/search/'
+CHUNK_SIZE = 16384 # bytes read from the response at a time
+PAGE_START = 'describe-isbn-title' # parsing starts at the tag holding this
+DEFAULT_CHARSET = 'utf-8'
 DEFAULT_CURRENCY = 'EUR'
 DEFAULT_DESTINATION = 'fr'
+CSV_FIELDS = ['url', 'price_raw', 'isbn', 'condition']
 JUSTIFY = 11
 LINE_LEN = 80 # chars per line
 
@@ -55,41 +68,89 @@ argp.add_argument('isbn',
                   type=str)
 args = argp.parse_args()
 
-def sanitise_isbn(isbn):
-	return ''.join(i for i in str(isbn) if i.isdigit())
+# deletes every non-digit ASCII character (hyphens, spaces, letters...)
+_NON_DIGITS = str.maketrans('', '', ''.join(
+	chr(c) for c in range(128) if not chr(c).isdigit()
+))
+
+def sanitise_isbn(isbn: str) -> str:
+	s = str(isbn)
+	if s.isascii():
+		return s.translate(_NON_DIGITS)
+	# pasted ISBNs often carry Unicode dashes or non-breaking spaces, which the
+	# ASCII table would leave behind
+	return ''.join(c for c in s if c.isdigit())
 
-def check_isbn(isbn):
+_ISBN10_WEIGHTS = range(10, 0, -1)
+
+def check_isbn(isbn: str) -> bool:
 	if len(isbn) == 9:
 		# convert SBN to ISBN-10
 		isbn = '0' + isbn
 	if len(isbn) == 10:
-		# ISBN-10
-		s = 0
-		t = 0
-		for i in range(10):
-			t += int(isbn[i])
-			s += t
+		# ISBN-10: digits weighted 10 down to 1
+		s: int = sum(map(operator.mul, map(int, isbn), _ISBN10_WEIGHTS))
 		return s % 11 == 0
 	elif len(isbn) == 13:
-		# ISBN-13
-		o = [int(i) for i in isbn[::2]]
-		e = [int(i)*3 for i in isbn[1::2]]
-		return (sum(o)+sum(e)) % 10 == 0
+		# ISBN-13: odd positions weighted 1, even positions weighted 3
+		s = sum(map(int, isbn[::2])) + 3 * sum(map(int, isbn[1::2]))
+		return s % 10 == 0
 	else:
 		return False
 
-def form_url(isbn, currency, destination):
-	# encode the url properly
-	isbn = urllib.parse.quote(isbn)
+@functools.lru_cache(maxsize=128)
+def form_url(isbn: str, currency: str, destination: str) -> str:
+	# encode the url properly - an ISBN of plain ASCII digits needs no quoting,
+	# but isdigit() alone also accepts full-width and other Unicode digits
+	if not (isbn.isascii() and isbn.isdigit()):
+		isbn = urllib.parse.quote(isbn)
 	currency = urllib.parse.quote(currency)
 	return API_URL + '?keywords=' + isbn + '&currency=' + currency + \
 	       '&destination=' + destination + '&lang=en&st=sh&ac=qr&submit='
 
-def fetch_book(isbn, currency, destination):
+def fetch_book(isbn: str, currency: str,
+               destination: str) -> http.client.HTTPResponse:
 	url = form_url(isbn, currency, destination)
-	data = urllib.request.urlopen(url)
+	req = urllib.request.Request(url, headers={
+		'Accept-Encoding': 'gzip',
+		'User-Agent': 'bookfind/{}'.format(VERSION)
+	})
+	data: http.client.HTTPResponse = urllib.request.urlopen(req)
 	return data
 
+def read_text(body: io.BufferedIOBase,
+              decoder: codecs.IncrementalDecoder) -> Iterator[str]:
+	# text is only handed out up to the last '<' seen - HTMLParser passes a
+	# text node that straddles two feed() calls to handle_data in pieces, so
+	# every piece must end where a tag begins
+	pending = ''
+	while True:
+		chunk = body.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		pending += decoder.decode(chunk)
+		i = pending.rfind('<')
+		if i > 0:
+			yield pending[:i]
+			pending = pending[i:]
+	yield pending + decoder.decode(b'', final=True)
+
+def skip_preamble(chunks: Iterator[str], marker: str) -> Iterator[str]:
+	# everything before the book title is navigation and adverts that the
+	# parser would only walk through - drop it and start at the tag holding
+	# the marker. only the last, possibly unfinished, tag is kept while
+	# searching so the marker is found even if split across chunks
+	pending = ''
+	for text in chunks:
+		pending += text
+		i = pending.find(marker)
+		if i != -1:
+			yield pending[max(pending.rfind('<', 0, i), 0):]
+			break
+		i = pending.rfind('<')
+		pending = pending[i:] if i != -1 else ''
+	yield from chunks
+
 SECTION_IGNORE1  = 0
 SECTION_NEW      = 1
 SECTION_USED     = 2
@@ -105,58 +166,91 @@ DATA_TITLE       = 1
 DATA_DESCRIPTION = 2
 DATA_PRICE       = 3
 
+CLASS_NONE       = 0
+CLASS_DESCRIBE   = 1
+CLASS_LOGO       = 2
+CLASS_PRICE      = 3
+CLASS_NOTE       = 4
+
+# class attribute value -> action, resolved with a single dict probe per tag.
+# keyed on str | None since a valueless class attribute comes through as None
+_CLASS_ACTIONS: dict[str | None, int] = {
+	'describe-isbn':      CLASS_DESCRIBE,
+	'results-table-Logo': CLASS_LOGO,
+	'results-price':      CLASS_PRICE,
+	'item-note':          CLASS_NOTE
+}
+
+# attributes handle_starttag() acts on - tags without any of these are skipped
+_WANTED_ATTRS = frozenset(('id', 'class', 'data-price', 'data-pub_date'))
+
+# the target of a price link, stored in the 'bu' query parameter
+_BU_RE = re.compile(r'[?&]bu=([^&#]*)')
+
+# the numeric part of a displayed price such as '€ 12.90'
+_PRICE_RE = re.compile(r'(\d+(?:\.\d+)?)')
+
+class BookEntry:
+	# a single result - slots keep each entry down to its fixed fields with no
+	# per-instance __dict__. an entry without a usable price keeps price_raw at
+	# infinity so it sorts after every priced offer
+	__slots__ = ('price', 'price_raw', 'date', 'url', 'desc')
+
+	def __init__(self) -> None:
+		self.price: str | None = None
+		self.price_raw: float = float('inf')
+		self.date: str | None = None
+		self.url: str | None = None
+		self.desc: list[str] = []
+
 class BookHTMLParser(HTMLParser):
-	def __init__(self):
+	def __init__(self) -> None:
 		super().__init__()
-		self.section = 0
-		self.books_new = []
-		self.books_used = []
-		self.entry_default = {
-			'price':None, 'date':None, 'url':None, 'desc':[]
-		}
-		self.entry = copy.deepcopy(self.entry_default)
-		self.adding = False
-		self.data_fetch = DATA_NONE
-		self.desc_fetch = DESC_NONE
-		self.desc_fetch_tmp = DESC_NONE
-		self.title = None
-		self.publisher = None
-		self.edition = None
-		self.language = None
+		self.section: int = 0
+		self.books_new: list[BookEntry] = []
+		self.books_used: list[BookEntry] = []
+		self.entry: BookEntry = BookEntry()
+		self.adding: bool = False
+		self.data_fetch: int = DATA_NONE
+		self.desc_fetch: int = DESC_NONE
+		self.desc_fetch_tmp: int = DESC_NONE
+		self.title: str | None = None
+		self.publisher: str | None = None
+		self.edition: str | None = None
+		self.language: str | None = None
 
-	def extract_title(self):
+	def extract_title(self) -> str | None:
 		return self.title
 
-	def extract_publisher(self):
+	def extract_publisher(self) -> str | None:
 		return self.publisher
 
-	def extract_edition(self):
+	def extract_edition(self) -> str | None:
 		return self.edition
 
-	def extract_language(self):
+	def extract_language(self) -> str | None:
 		return self.language
 
-	def extract_new(self):
+	def extract_new(self) -> list[BookEntry]:
 		return self.books_new
 
-	def extract_used(self):
+	def extract_used(self) -> list[BookEntry]:
 		return self.books_used
 
-	def handle_starttag(self, tag, attrs):
+	def handle_starttag(self, tag: str,
+	                    attrs: list[tuple[str, str | None]]) -> None:
 		if tag == 'br' or tag == 'link':
 			return
 		if tag == 'a':
 			if self.data_fetch == DATA_PRICE:
-				for attrib in attrs:
-					if attrib[0] == 'href':
-						bigurl = str(attrib[1])
-						# the URL is encoded as a redirect link with the target
-						# URL hidden within as an encoded parameter - we need to
-						# extract this URL
-						parsed = urllib.parse.urlparse(bigurl)
-						urlparts = urllib.parse.parse_qs(parsed.query)
-						self.entry['url'] = urlparts['bu'][0]
-						break
+				bigurl = dict(attrs).get('href')
+				if bigurl is not None:
+					# the URL is encoded as a redirect link with the target URL
+					# hidden within as an encoded parameter - we need to
+					# extract this URL
+					m = _BU_RE.search(bigurl)
+					if m is not None:
+						self.entry.url = urllib.parse.unquote_plus(m.group(1))
 			if self.data_fetch == DATA_DESCRIPTION:
 				# cancel description scraping because <a> links in the desc are
 				# normally amazon prime links or other garbage that we don't
@@ -164,83 +258,127 @@ class BookHTMLParser(HTMLParser):
 				self.data_fetch = DATA_NONE
 			return
 		self.data_fetch = DATA_NONE
-		for attrib in attrs:
-			if attrib[0] == 'id' and attrib[1] == 'describe-isbn-title':
-				self.data_fetch = DATA_TITLE
-			if attrib[0] == 'class' and attrib[1] == 'describe-isbn':
-				self.desc_fetch_tmp += 1
-				self.desc_fetch += self.desc_fetch_tmp
-			if attrib[0] == 'class' and attrib[1] == 'results-table-Logo':
-				self.section += 1
-			if attrib[0] == 'data-price':
-				# only add if we've already started adding.
-				# 'data-price' is only found at the start of a new entry
-				if self.adding is True:
-					if self.section == SECTION_NEW:
-						self.books_new += [copy.deepcopy(self.entry)]
-					elif self.section == SECTION_USED:
-						self.books_used += [copy.deepcopy(self.entry)]
-					self.entry = copy.deepcopy(self.entry_default)
-				self.adding = True
-			if attrib[0] == 'class' and attrib[1] == 'results-price':
-				self.data_fetch = DATA_PRICE
-			if attrib[0] == 'data-pub_date':
-				self.entry['date'] = str(attrib[1])
-			if attrib[0] == 'class' and attrib[1] == 'item-note':
-				self.data_fetch = DATA_DESCRIPTION
-
-	def money_strip(self, price_str):
-		stripped = ''
-		dot = False
-		for c in price_str:
-			if c.isdigit() or (not dot and c == '.'):
-				stripped += c
-				if c == '.':
-					dot = True
-		return stripped
-
-	def handle_data(self, data):
+		# most tags on the page carry nothing we look at - bail out before
+		# doing any per-attribute work on them
+		if not attrs:
+			return
+		a = dict(attrs)
+		if a.keys().isdisjoint(_WANTED_ATTRS):
+			return
+		if a.get('id') == 'describe-isbn-title':
+			self.data_fetch = DATA_TITLE
+		action = _CLASS_ACTIONS.get(a.get('class'), CLASS_NONE)
+		if action == CLASS_DESCRIBE:
+			self.desc_fetch_tmp += 1
+			self.desc_fetch += self.desc_fetch_tmp
+		elif action == CLASS_LOGO:
+			self.section += 1
+		elif action == CLASS_PRICE:
+			self.data_fetch = DATA_PRICE
+		elif action == CLASS_NOTE:
+			self.data_fetch = DATA_DESCRIPTION
+		if 'data-price' in a:
+			# only add if we've already started adding.
+			# 'data-price' is only found at the start of a new entry
+			if self.adding is True:
+				# the finished entry is handed over as-is and a fresh one is
+				# started, so nothing needs to be copied
+				if self.section == SECTION_NEW:
+					self.books_new.append(self.entry)
+				elif self.section == SECTION_USED:
+					self.books_used.append(self.entry)
+				self.entry = BookEntry()
+			self.adding = True
+		date = a.get('data-pub_date')
+		if date is not None:
+			self.entry.date = date
+
+	def money_strip(self, price_str: str) -> str | None:
+		# thousands separators are dropped so '1,050.00' reads as 1050.00.
+		# None when there is no number at all, e.g. 'Price on request'
+		m = _PRICE_RE.search(price_str.replace(',', ''))
+		return m.group(1) if m is not None else None
+
+	def handle_data(self, data: str) -> None:
+		# most text nodes are whitespace between tags we aren't reading - skip
+		# them before stripping anything
+		if self.data_fetch == DATA_NONE and self.desc_fetch == DESC_NONE:
+			return
 		data = data.strip()
 		#if self.data_fetch != DATA_NONE:
 		#	print('<<<', data, '>>>')
-		if data == '':
+		if not data:
 			return
 		if self.data_fetch == DATA_TITLE:
-			self.title = str(data)
+			self.title = data
 		elif self.data_fetch == DATA_DESCRIPTION:
-			self.entry['desc'] += [str(data)]
+			self.entry.desc.append(data)
 		elif self.data_fetch == DATA_PRICE:
-			self.entry['price'] = str(data)
-			self.entry['price_raw'] = float(self.money_strip(str(data)))
+			self.entry.price = data
+			stripped = self.money_strip(data)
+			if stripped is not None:
+				self.entry.price_raw = float(stripped)
 		elif self.desc_fetch == DESC_PUBLISHER:
-			self.publisher = str(data)
+			self.publisher = data
 		elif self.desc_fetch == DESC_EDITION:
-			self.edition = str(data)
+			self.edition = data
 		elif self.desc_fetch == DESC_LANGUAGE:
-			self.language = str(data)
+			self.language = data
 		self.desc_fetch = DESC_NONE
 
-def print_align(header, data, color=None, gap=0, just=0):
-	align = ''.ljust(JUSTIFY+just)
-	gapalign = ''.ljust(gap)
-	if not isinstance(data, list):
-		data = [data]
-	for idx,i in enumerate(data):
-		hdr = header.ljust(JUSTIFY+just)
-		if color is not None:
-			hdr = str(color) + hdr + '\033[00m'
+# padding strings are only ever a handful of distinct widths, so build each
+# one once
+_PAD_CACHE: dict[int, str] = {}
+
+def pad(n: int) -> str:
+	s = _PAD_CACHE.get(n)
+	if s is None:
+		s = _PAD_CACHE[n] = ' ' * n
+	return s
+
+def print_align(header: str, data: str | list[str] | None,
+                color: str | None = None, gap: int = 0, just: int = 0) -> str:
+	# returns the aligned lines rather than printing them so that callers can
+	# write everything out in one go
+	align = pad(JUSTIFY+just)
+	gapalign = pad(gap)
+	items = data if isinstance(data, list) else [data]
+	hdr = header.ljust(JUSTIFY+just)
+	if color is not None:
+		hdr = color + hdr + '\033[00m'
+	lines = []
+	for idx,i in enumerate(items):
 		if idx == 0:
-			print(gapalign + hdr, ':', str(i).strip())
+			lines.append(gapalign + hdr + ' : ' + str(i).strip() + '\n')
 		else:
-			print(gapalign + align + '  ', i.strip())
+			lines.append(gapalign + align + '   ' + str(i).strip() + '\n')
+	return ''.join(lines)
+
+def format_book(out: list[str], book: BookEntry) -> None:
+	out.append('-' * (LINE_LEN // 2) + '\n')
+	out.append('\033[91mPrice\033[00m : ' + str(book.price) + '\n')
+	out.append(print_align('Date', book.date, gap=4))
+	out.append(print_align('Description', book.desc, gap=4))
+	out.append(print_align('URL', book.url, gap=4))
+	out.append('\n')
 
-def output_results(parser, isbn, filename):
+def csv_row(book: BookEntry, isbn: str, condition: str) -> dict[str, object]:
+	# an entry without a price keeps price_raw at infinity for sorting - leave
+	# the column empty rather than writing a made-up figure
+	price_raw = book.price_raw if book.price_raw != float('inf') else ''
+	return {'url':book.url, 'price_raw':price_raw,
+	        'isbn':isbn, 'condition':condition}
+
+def output_results(parser: BookHTMLParser, isbn: str,
+                   filename: str | None) -> None:
 	title      = parser.extract_title()
 	publisher  = parser.extract_publisher()
 	edition    = parser.extract_edition()
 	language   = parser.extract_language()
-	books_new  = sorted(parser.extract_new(), key=lambda d:d['price_raw'])
-	books_used = sorted(parser.extract_used(),key=lambda d:d['price_raw'])
+	# price_raw is the float parsed once per entry, so this is a numeric sort
+	by_price   = operator.attrgetter('price_raw')
+	books_new  = sorted(parser.extract_new(), key=by_price)
+	books_used = sorted(parser.extract_used(), key=by_price)
 	if args.limit > 0:
 		books_new = books_new[:args.limit]
 		books_used = books_used[:args.limit]
@@ -252,57 +390,36 @@ def output_results(parser, isbn, filename):
 		print('error: no book could be found')
 		exit(1)
 	if filename is not None:
-		# we're dumping to csv - remove unnecessary columns and add others
-		for book in books_new:
-			book.pop('desc')
-			book.pop('price')
-			book.pop('date')
-			book['isbn'] = isbn
-			book['condition'] = 'new'
-		for book in books_used:
-			book.pop('desc')
-			book.pop('price')
-			book.pop('date')
-			book['isbn'] = isbn
-			book['condition'] = 'used'
-		with open(filename, 'w') as f:
-			w = csv.writer(f)
-			if len(books_new) > 0:
-				w.writerow(books_new[0])
-			else:
-				w.writerow(books_used[0])
+		# we're dumping to csv - rows are built from the entries rather than
+		# stripping the entries themselves down
+		with open(filename, 'w', newline='') as f:
+			w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+			w.writeheader()
 			if args.new is True or args.used is False:
 				for book in books_new:
-					w.writerow(book.values())
+					w.writerow(csv_row(book, isbn, 'new'))
 			if args.used:
 				for book in books_used:
-					w.writerow(book.values())
+					w.writerow(csv_row(book, isbn, 'used'))
 	else:
+		# collect the whole report and write it with a single call
+		out: list[str] = []
 		if args.used:
-			print()
+			out.append('\n')
 			for book in books_used:
-				print('-' * (LINE_LEN // 2))
-				print('\033[91mPrice\033[00m :', book['price'])
-				print_align('Date', book['date'], gap=4)
-				print_align('Description', book['desc'], gap=4)
-				print_align('URL', book['url'], gap=4)
-				print()
-			print('\033[92mUsed books\033[00m')
+				format_book(out, book)
+			out.append('\033[92mUsed books\033[00m\n')
 		if args.new is True or args.used is False:
-			print()
+			out.append('\n')
 			for book in books_new:
-				print('-' * (LINE_LEN // 2))
-				print('\033[91mPrice\033[00m :', book['price'])
-				print_align('Date', book['date'], gap=4)
-				print_align('Description', book['desc'], gap=4)
-				print_align('URL', book['url'], gap=4)
-				print()
-			print('\033[92mNew books\033[00m')
-		print()
-		print_align('Tile', title, color='\033[93m')
-		print_align('Publisher', publisher, color='\033[93m')
-		print_align('Edition', edition, color='\033[93m')
-		print_align('Language', language, color='\033[93m')
+				format_book(out, book)
+			out.append('\033[92mNew books\033[00m\n')
+		out.append('\n')
+		out.append(print_align('Tile', title, color='\033[93m'))
+		out.append(print_align('Publisher', publisher, color='\033[93m'))
+		out.append(print_align('Edition', edition, color='\033[93m'))
+		out.append(print_align('Language', language, color='\033[93m'))
+		stdout.write(''.join(out))
 
 try:
 	isbn = sanitise_isbn(args.isbn)
@@ -326,13 +443,22 @@ try:
 	if args.output is not None:
 		print('fetching and saving to CSV - this may take some time...')
 	data = fetch_book(isbn, currency, destination)
-	htmldata = data.read()
-	try:
-		htmldata = htmldata.decode('windows-1252')
-	except Exception:
-		htmldata = htmldata.decode('UTF-8')
+	body: io.BufferedIOBase = data
+	if data.headers.get('Content-Encoding') == 'gzip':
+		body = gzip.GzipFile(fileobj=data)
 	parser = BookHTMLParser()
-	parser.feed(htmldata)
+	# parse the page as it arrives rather than buffering the whole response -
+	# the incremental decoder keeps multi-byte sequences that straddle two
+	# chunks intact. the page is decoded once using the charset the server
+	# declares
+	charset = data.headers.get_content_charset() or DEFAULT_CHARSET
+	try:
+		decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+	except LookupError:
+		decoder = codecs.getincrementaldecoder(DEFAULT_CHARSET)(errors='replace')
+	for text in skip_preamble(read_text(body, decoder), PAGE_START):
+		parser.feed(text)
+	parser.close()
 	output_results(parser, isbn, args.output)
 except urllib.error.URLError as e:
 	err = str(e)